@@ -2,16 +2,55 @@
 """
 Requirements Installation Script
 Installs packages from requirements.txt file.
+
+With --locked, the requirements file must be fully pinned and hash-locked
+(e.g. generated by `pip-compile --generate-hashes`), and every wheel must be
+present in --wheelhouse; pip then installs without resolving dependencies.
 """
 
 import os
+import shutil
 import sys
 import subprocess
 import argparse
+import tempfile
 from pathlib import Path
 
 
-def install_requirements(requirements_file, python_path=None):
+_HOME = Path.home()
+
+
+WHEEL_CACHE_DIR = _HOME / ".cache" / "duke-slurm" / "wheels"
+
+
+def install_from_wheels(python_path, requirements_file):
+    """Build the full set of wheels once, then install them in one pass.
+    
+    Wheels are built with `pip wheel` so sdists are compiled while the index
+    is still reachable, and previously built wheels are reused from
+    WHEEL_CACHE_DIR. The install itself is a single --no-deps --no-index pip
+    process, since concurrent pip runs into one site-packages are not safe.
+    """
+    WHEEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="wheelhouse-") as wheelhouse:
+        # Single resolve: builds the full dependency closure into the wheelhouse
+        wheel_cmd = [python_path, "-m", "pip", "wheel", "-w", wheelhouse,
+                     "--find-links", str(WHEEL_CACHE_DIR), "-r", requirements_file]
+        subprocess.run(wheel_cmd, check=True)
+        
+        wheels = sorted(Path(wheelhouse).glob("*.whl"))
+        for wheel in wheels:
+            cached = WHEEL_CACHE_DIR / wheel.name
+            if not cached.exists():
+                shutil.copy2(wheel, cached)
+        
+        print(f"Installing {len(wheels)} prebuilt wheels")
+        install_cmd = [python_path, "-m", "pip", "install", "--no-deps", "--no-index",
+                       "--find-links", wheelhouse] + [str(wheel) for wheel in wheels]
+        subprocess.run(install_cmd, check=True)
+
+
+def install_requirements(requirements_file, python_path=None, prebuild=False, wheelhouse=None):
     """Install requirements from file."""
     if not os.path.exists(requirements_file):
         print(f"Error: {requirements_file} not found!")
@@ -20,28 +59,31 @@ def install_requirements(requirements_file, python_path=None):
     if python_path is None:
         # Try to find conda environment
         conda_paths = [
-            os.path.expanduser("~/miniconda3/envs/torchpy310/bin/python"),
-            os.path.expanduser("~/anaconda3/envs/torchpy310/bin/python"),
-            "/opt/conda/envs/torchpy310/bin/python"
+            _HOME / "miniconda3" / "envs" / "torchpy310" / "bin" / "python",
+            _HOME / "anaconda3" / "envs" / "torchpy310" / "bin" / "python",
+            Path("/opt/conda/envs/torchpy310/bin/python")
         ]
         
-        for path in conda_paths:
-            expanded_path = os.path.expanduser(path)
-            if os.path.exists(expanded_path):
-                python_path = expanded_path
-                break
-        
-        if python_path is None:
-            python_path = "python3"
+        # os.access checks existence and executability in one syscall
+        python_path = (next((str(path) for path in conda_paths if os.access(path, os.X_OK)), None)
+                       or shutil.which("python3") or sys.executable)
     
     print(f"Using Python: {python_path}")
     print(f"Installing from: {requirements_file}")
     
     # Install requirements
-    cmd = [python_path, "-m", "pip", "install", "-r", requirements_file]
-    
     try:
-        result = subprocess.run(cmd, check=True)
+        if prebuild:
+            install_from_wheels(python_path, requirements_file)
+        else:
+            if wheelhouse:
+                # Locked install: no resolver, no index, prebuilt wheels only
+                print(f"Using wheelhouse: {wheelhouse}")
+                cmd = [python_path, "-m", "pip", "install", "--no-deps", "--only-binary=:all:",
+                       "--no-index", "--find-links", wheelhouse, "-r", requirements_file]
+            else:
+                cmd = [python_path, "-m", "pip", "install", "-r", requirements_file]
+            subprocess.run(cmd, check=True)
         print("✅ Requirements installed successfully!")
         return True
     except subprocess.CalledProcessError as e:
@@ -54,10 +96,25 @@ def main():
     parser.add_argument("--requirements", "-r", default="requirements.txt",
                        help="Requirements file path")
     parser.add_argument("--python", "-p", help="Python executable path")
+    parser.add_argument("--prebuild-wheels", action="store_true",
+                       help="Build all wheels with one resolve (reusing cached wheels), "
+                            "then install them without re-resolving")
+    parser.add_argument("--wheelhouse", help="Directory of prebuilt wheels for --locked installs")
+    parser.add_argument("--locked", action="store_true",
+                       help="Install a fully pinned, hash-locked requirements file from --wheelhouse "
+                            "without dependency resolution")
     
     args = parser.parse_args()
     
-    success = install_requirements(args.requirements, args.python)
+    if args.locked and not args.wheelhouse:
+        parser.error("--locked requires --wheelhouse")
+    if args.wheelhouse and not args.locked:
+        parser.error("--wheelhouse is only used with --locked")
+    if args.locked and args.prebuild_wheels:
+        parser.error("--prebuild-wheels cannot be combined with --locked")
+    
+    success = install_requirements(args.requirements, args.python, prebuild=args.prebuild_wheels,
+                                   wheelhouse=args.wheelhouse)
     
     if success:
         print("\n🎉 Installation completed!")
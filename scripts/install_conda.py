@@ -5,18 +5,132 @@ Automatically installs conda if not present on the system.
 """
 
 import os
+import functools
+import glob
+import shutil
 import sys
 import subprocess
 import platform
+import re
 import argparse
+import hashlib
 from pathlib import Path
 
+try:
+    import httpx
+except ImportError:  # httpx is optional; fall back to urllib
+    httpx = None
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+_HOME = Path.home()
+_HOME_PATTERN = glob.escape(str(_HOME))
+INSTALLER_CACHE_DIR = _HOME / ".cache" / "duke-slurm" / "installers"
+
+
+@functools.lru_cache(maxsize=None)
+def _glob_first(pattern):
+    """Return the first path matching pattern (memoized), or None."""
+    matches = sorted(glob.glob(pattern))
+    return matches[0] if matches else None
+
+
+def find_conda_sh():
+    """Return the path to conda.sh of the active or a standard conda install, or None."""
+    # Standard install locations first; globs only as a fallback so that
+    # backups like ~/miniconda3-old never shadow the live install
+    possible_paths = [
+        f"{_HOME_PATTERN}/miniconda3/etc/profile.d/conda.sh",
+        f"{_HOME_PATTERN}/anaconda3/etc/profile.d/conda.sh",
+        "/opt/conda/etc/profile.d/conda.sh",
+        "/usr/local/conda/etc/profile.d/conda.sh",
+        "/opt/miniconda3/etc/profile.d/conda.sh",
+        "/opt/anaconda3/etc/profile.d/conda.sh",
+        f"{_HOME_PATTERN}/miniconda*/etc/profile.d/conda.sh",
+        f"{_HOME_PATTERN}/anaconda*/etc/profile.d/conda.sh",
+        "/opt/miniconda*/etc/profile.d/conda.sh",
+        "/opt/anaconda*/etc/profile.d/conda.sh"
+    ]
+    
+    # conda on PATH points straight at its install prefix
+    conda_bin = shutil.which("conda")
+    if conda_bin:
+        prefix = Path(os.path.realpath(conda_bin)).parent.parent
+        possible_paths.insert(0, glob.escape(str(prefix / "etc" / "profile.d" / "conda.sh")))
+    
+    return next(filter(None, map(_glob_first, possible_paths)), None)
+
+
+_CONDA_SOURCE_RE = re.compile(r'^source ".*conda\.sh"$', re.M)
+
+
+def _ensure_line(path, line):
+    """Make sure path sources conda via line; return True if the file changed.
+    
+    An existing conda.sh source line for a different install is replaced in
+    place, so repeated installs do not stack up source lines.
+    """
+    with path.open("r+") as f:
+        content = f.read()
+        if line in content:
+            return False
+        
+        if _CONDA_SOURCE_RE.search(content):
+            f.seek(0)
+            f.write(_CONDA_SOURCE_RE.sub(lambda m: line, content, count=1))
+            f.truncate()
+        else:
+            f.write(f"\n# Conda initialization\n{line}\n")
+    return True
+
+
+def sha256_file(path, chunk_size=1 << 20):
+    """Compute the SHA-256 digest of a file."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h
+
 
 class CondaInstaller:
+    _BASE_URL = "https://repo.anaconda.com"
+    _URLS = {
+        ("linux", "x86_64"): {
+            "miniconda": f"{_BASE_URL}/miniconda/Miniconda3-latest-Linux-x86_64.sh",
+            "anaconda": f"{_BASE_URL}/archive/Anaconda3-2023.09-0-Linux-x86_64.sh",
+        },
+        ("linux", "arm64"): {
+            "miniconda": f"{_BASE_URL}/miniconda/Miniconda3-latest-Linux-aarch64.sh",
+            "anaconda": f"{_BASE_URL}/archive/Anaconda3-2023.09-0-Linux-aarch64.sh",
+        },
+        ("darwin", "x86_64"): {
+            "miniconda": f"{_BASE_URL}/miniconda/Miniconda3-latest-MacOSX-x86_64.sh",
+            "anaconda": f"{_BASE_URL}/archive/Anaconda3-2023.09-0-MacOSX-x86_64.sh",
+        },
+        ("darwin", "arm64"): {
+            "miniconda": f"{_BASE_URL}/miniconda/Miniconda3-latest-MacOSX-arm64.sh",
+            "anaconda": f"{_BASE_URL}/archive/Anaconda3-2023.09-0-MacOSX-arm64.sh",
+        },
+    }
+    
     def __init__(self):
         self.system = platform.system().lower()
         self.machine = platform.machine().lower()
         
+        if "arm64" in self.machine or "aarch64" in self.machine:
+            arch = "arm64"
+        elif "x86_64" in self.machine or "amd64" in self.machine:
+            arch = "x86_64"
+        else:
+            arch = None
+        self._key = (self.system, arch)
+        
     def check_conda_installed(self):
         """Check if conda is already installed."""
         try:
@@ -28,67 +142,187 @@ class CondaInstaller:
     
     def find_conda_path(self):
         """Find existing conda installation."""
-        possible_paths = [
-            "~/miniconda3/etc/profile.d/conda.sh",
-            "~/anaconda3/etc/profile.d/conda.sh",
-            "/opt/conda/etc/profile.d/conda.sh",
-            "/usr/local/conda/etc/profile.d/conda.sh",
-            "/opt/miniconda3/etc/profile.d/conda.sh",
-            "/opt/anaconda3/etc/profile.d/conda.sh"
-        ]
-        
-        for path in possible_paths:
-            expanded_path = os.path.expanduser(path)
-            if os.path.exists(expanded_path):
-                return expanded_path
-        return None
+        return find_conda_sh()
     
     def get_download_url(self, installer_type="miniconda"):
         """Get the appropriate download URL for conda."""
-        base_url = "https://repo.anaconda.com"
-        
-        if installer_type == "miniconda":
-            if self.system == "linux":
-                if "x86_64" in self.machine or "amd64" in self.machine:
-                    return f"{base_url}/miniconda/Miniconda3-latest-Linux-x86_64.sh"
-                elif "aarch64" in self.machine or "arm64" in self.machine:
-                    return f"{base_url}/miniconda/Miniconda3-latest-Linux-aarch64.sh"
-            elif self.system == "darwin":  # macOS
-                if "x86_64" in self.machine:
-                    return f"{base_url}/miniconda/Miniconda3-latest-MacOSX-x86_64.sh"
-                elif "arm64" in self.machine or "aarch64" in self.machine:
-                    return f"{base_url}/miniconda/Miniconda3-latest-MacOSX-arm64.sh"
-        elif installer_type == "anaconda":
-            if self.system == "linux":
-                if "x86_64" in self.machine or "amd64" in self.machine:
-                    return f"{base_url}/archive/Anaconda3-2023.09-0-Linux-x86_64.sh"
-                elif "aarch64" in self.machine or "arm64" in self.machine:
-                    return f"{base_url}/archive/Anaconda3-2023.09-0-Linux-aarch64.sh"
-            elif self.system == "darwin":
-                if "x86_64" in self.machine:
-                    return f"{base_url}/archive/Anaconda3-2023.09-0-MacOSX-x86_64.sh"
-                elif "arm64" in self.machine or "aarch64" in self.machine:
-                    return f"{base_url}/archive/Anaconda3-2023.09-0-MacOSX-arm64.sh"
-        
-        raise RuntimeError(f"Unsupported system: {self.system} {self.machine}")
+        try:
+            return self._URLS[self._key][installer_type]
+        except KeyError:
+            raise RuntimeError(f"Unsupported system: {self.system} {self.machine}") from None
     
-    def download_installer(self, url, installer_type="miniconda"):
-        """Download the conda installer."""
-        import urllib.request
+    def create_session(self):
+        """Create an HTTP client that reuses one (HTTP/2 when available) connection."""
+        return httpx.Client(
+            http2=HTTP2_AVAILABLE,
+            timeout=30,
+            follow_redirects=True,
+            transport=httpx.HTTPTransport(http2=HTTP2_AVAILABLE, retries=3),
+        )
+    
+    def stream_download(self, session, url, dest, attempts=3):
+        """Stream url to dest, resuming a partial download on retry.
         
-        installer_name = f"{installer_type}_installer.sh"
-        installer_path = Path.home() / installer_name
+        A partial file is only resumed with an If-Range validator (ETag or
+        Last-Modified) saved from the response that started it, so bytes from
+        an older build are never spliced onto a newer one.
         
-        print(f"Downloading {installer_type} installer...")
-        print(f"URL: {url}")
+        Returns the SHA-256 hex digest of the downloaded file, computed
+        while the bytes are written.
+        """
+        partial_path = dest.with_name(dest.name + ".part")
+        validator_path = dest.with_name(dest.name + ".part.validator")
         
+        for attempt in range(1, attempts + 1):
+            existing = 0
+            headers = {}
+            if partial_path.exists() and validator_path.exists():
+                existing = partial_path.stat().st_size
+                headers = {"Range": f"bytes={existing}-", "If-Range": validator_path.read_text().strip()}
+            
+            try:
+                with session.stream("GET", url, headers=headers) as r:
+                    if r.status_code == 416 and existing:
+                        # Validator still matches and the partial file holds the whole installer
+                        h = sha256_file(partial_path)
+                        break
+                    r.raise_for_status()
+                    
+                    # Server sends the full file if the Range was ignored or the validator changed
+                    if r.status_code == 206:
+                        mode, h = "ab", sha256_file(partial_path)
+                    else:
+                        mode, h = "wb", hashlib.sha256()
+                        etag = r.headers.get("ETag")
+                        validator = etag if etag and not etag.startswith("W/") else r.headers.get("Last-Modified")
+                        if validator:
+                            validator_path.write_text(validator)
+                        else:
+                            validator_path.unlink(missing_ok=True)
+                    with open(partial_path, mode) as f:
+                        for chunk in r.iter_bytes(1 << 20):
+                            h.update(chunk)
+                            f.write(chunk)
+                break
+            except httpx.HTTPError as e:
+                if attempt == attempts:
+                    raise
+                print(f"Download interrupted ({e}), resuming...")
+        
+        partial_path.replace(dest)
+        validator_path.unlink(missing_ok=True)
+        return h.hexdigest()
+    
+    def fetch_expected_sha256(self, session, url):
+        """Fetch the published SHA-256 digest for url, or None if unavailable."""
+        checksum_url = f"{url}.sha256"
+        try:
+            if session is not None:
+                r = session.get(checksum_url)
+                if r.status_code != 200:
+                    return None
+                text = r.text
+            else:
+                import urllib.request
+                with urllib.request.urlopen(checksum_url, timeout=30) as r:
+                    text = r.read().decode()
+        except Exception:
+            return None
+        
+        # Sidecar format is "<digest>" or "<digest>  <filename>"; anything
+        # else (e.g. an HTML error page served with 200) is not a checksum
+        fields = text.split()
+        digest = fields[0].lower() if fields else ""
+        return digest if re.fullmatch(r"[0-9a-f]{64}", digest) else None
+    
+    def fetch_validator(self, session, url):
+        """Return the server's strong ETag or Last-Modified for url, or None."""
+        try:
+            if session is not None:
+                headers = session.head(url).headers
+            else:
+                import urllib.request
+                request = urllib.request.Request(url, method="HEAD")
+                with urllib.request.urlopen(request, timeout=30) as r:
+                    headers = r.headers
+        except Exception:
+            return None
+        
+        etag = headers.get("ETag")
+        return etag if etag and not etag.startswith("W/") else headers.get("Last-Modified")
+    
+    def download_installer(self, url, installer_type="miniconda"):
+        """Download the conda installer, reusing a verified cached copy if present.
+        
+        Installers are cached under INSTALLER_CACHE_DIR keyed on the URL, with
+        their digest and the server's ETag/Last-Modified recorded next to them.
+        A cached copy is reused if it matches the published checksum or, when
+        none is published (as for repo.anaconda.com), if the server still
+        reports the same validator. If the server reports neither, the cache
+        pins the first download until the cached file is deleted.
+        """
+        INSTALLER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        key = hashlib.sha256(url.encode()).hexdigest()[:16]
+        installer_path = INSTALLER_CACHE_DIR / f"{key}.sh"
+        digest_path = installer_path.with_name(installer_path.name + ".sha256")
+        validator_path = installer_path.with_name(installer_path.name + ".validator")
+        
+        session = self.create_session() if httpx is not None else None
         try:
-            urllib.request.urlretrieve(url, installer_path)
+            expected = self.fetch_expected_sha256(session, url)
+            validator = self.fetch_validator(session, url)
+            
+            if installer_path.exists():
+                digest = sha256_file(installer_path).hexdigest()
+                recorded = digest_path.read_text().strip() if digest_path.exists() else None
+                saved_validator = validator_path.read_text().strip() if validator_path.exists() else None
+                
+                if expected is not None:
+                    reusable = digest == expected
+                elif digest != recorded:
+                    reusable = False
+                elif validator and saved_validator:
+                    reusable = validator == saved_validator
+                else:
+                    reusable = True
+                    print("Note: no checksum or ETag/Last-Modified available; reusing the installer "
+                          f"cached on first download (delete {installer_path} to refresh)")
+                
+                if reusable:
+                    print(f"Using cached {installer_type} installer: {installer_path}")
+                    return installer_path
+                print("Cached installer is stale or corrupt, downloading again")
+            
+            print(f"Downloading {installer_type} installer...")
+            print(f"URL: {url}")
+            
+            if session is not None:
+                digest = self.stream_download(session, url, installer_path)
+            else:
+                import urllib.request
+                urllib.request.urlretrieve(url, installer_path)
+                digest = sha256_file(installer_path).hexdigest()
             print(f"Downloaded to: {installer_path}")
+            
+            if expected is None:
+                print("Warning: no published checksum found, skipping verification")
+            elif digest != expected:
+                installer_path.unlink()
+                raise RuntimeError(f"Checksum mismatch: expected {expected}, got {digest}")
+            else:
+                print(f"Checksum verified: {digest}")
+            digest_path.write_text(f"{digest}\n")
+            if validator:
+                validator_path.write_text(f"{validator}\n")
+            else:
+                validator_path.unlink(missing_ok=True)
             return installer_path
         except Exception as e:
             print(f"Error downloading installer: {e}")
             return None
+        finally:
+            if session is not None:
+                session.close()
     
     def install_conda(self, installer_path, install_dir=None):
         """Install conda from the downloaded installer."""
@@ -96,7 +330,7 @@ class CondaInstaller:
             raise FileNotFoundError(f"Installer not found: {installer_path}")
         
         if install_dir is None:
-            install_dir = Path.home() / "miniconda3"
+            install_dir = _HOME / "miniconda3"
         
         print(f"Installing conda to: {install_dir}")
         
@@ -104,17 +338,12 @@ class CondaInstaller:
         os.chmod(installer_path, 0o755)
         
         # Run installer
-        install_cmd = f"bash {installer_path} -b -p {install_dir}"
-        print(f"Running: {install_cmd}")
+        install_cmd = ["bash", str(installer_path), "-b", "-p", str(install_dir)]
+        print(f"Running: {' '.join(install_cmd)}", flush=True)
         
         try:
-            result = subprocess.run(install_cmd, shell=True, check=True)
+            subprocess.run(install_cmd, check=True, stdout=sys.stdout, stderr=sys.stderr)
             print("Conda installation completed successfully!")
-            
-            # Clean up installer
-            installer_path.unlink()
-            print(f"Cleaned up installer: {installer_path}")
-            
             return install_dir
         except subprocess.CalledProcessError as e:
             print(f"Error during installation: {e}")
@@ -128,35 +357,14 @@ class CondaInstaller:
             print("Warning: conda.sh not found, shell integration may not work")
             return False
         
-        # Add to .bashrc if it exists
-        bashrc = Path.home() / ".bashrc"
-        if bashrc.exists():
-            conda_init_line = f'source "{conda_sh}"'
-            
-            with open(bashrc, 'r') as f:
-                content = f.read()
-            
-            if conda_init_line not in content:
-                with open(bashrc, 'a') as f:
-                    f.write(f"\n# Conda initialization\n{conda_init_line}\n")
-                print("Added conda initialization to .bashrc")
-        
-        # Add to .zshrc if it exists
-        zshrc = Path.home() / ".zshrc"
-        if zshrc.exists():
-            conda_init_line = f'source "{conda_sh}"'
-            
-            with open(zshrc, 'r') as f:
-                content = f.read()
-            
-            if conda_init_line not in content:
-                with open(zshrc, 'a') as f:
-                    f.write(f"\n# Conda initialization\n{conda_init_line}\n")
-                print("Added conda initialization to .zshrc")
+        conda_init_line = f'source "{conda_sh}"'
+        for rc_file in (_HOME / ".bashrc", _HOME / ".zshrc"):
+            if rc_file.exists() and _ensure_line(rc_file, conda_init_line):
+                print(f"Added conda initialization to {rc_file.name}")
         
         return True
     
-    def install(self, installer_type="miniconda", install_dir=None):
+    def install(self, installer_type="miniconda", install_dir=None, installer_url=None):
         """Main installation method."""
         print(f"Checking conda installation...")
         
@@ -174,7 +382,7 @@ class CondaInstaller:
         
         try:
             # Get download URL
-            url = self.get_download_url(installer_type)
+            url = installer_url or self.get_download_url(installer_type)
             
             # Download installer
             installer_path = self.download_installer(url, installer_type)
@@ -212,11 +420,12 @@ def main():
     parser.add_argument("--type", "-t", choices=["miniconda", "anaconda"], 
                        default="miniconda", help="Type of conda to install")
     parser.add_argument("--dir", "-d", help="Installation directory")
+    parser.add_argument("--installer-url", help="Download the installer from this URL (e.g. a mirror)")
     
     args = parser.parse_args()
     
     installer = CondaInstaller()
-    success = installer.install(args.type, args.dir)
+    success = installer.install(args.type, args.dir, args.installer_url)
     
     if success:
         print("\nInstallation successful! You can now use the setup_conda.py script.")
@@ -5,24 +5,50 @@ Automatically sets up conda environments for deep learning workloads.
 """
 
 import os
+import functools
+import glob
+import shutil
 import sys
 import subprocess
 import argparse
 import json
+import hashlib
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to json
+    orjson = None
+
+from install_conda import find_conda_sh
+
+
+_HOME = Path.home()
+CACHE_DIR = _HOME / ".cache" / "duke-slurm"
+
+
+@functools.lru_cache(maxsize=4)
+def _load_config_cached(path, mtime):
+    """Parse a config file; mtime is part of the cache key so edits are picked up."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
 
 class CondaSetup:
     def __init__(self, config_file="config/environments.json"):
         self.config_file = config_file
         self.config = self.load_config()
+        self._output = threading.local()
         
     def load_config(self):
         """Load environment configuration from JSON file."""
         config_path = Path(__file__).parent.parent / self.config_file
         if config_path.exists():
-            with open(config_path, 'r') as f:
-                return json.load(f)
+            return _load_config_cached(str(config_path), config_path.stat().st_mtime_ns)
         else:
             # Default configuration
             return {
@@ -80,77 +106,288 @@ class CondaSetup:
                 }
             }
     
-    def run_command(self, command, check=True):
-        """Run a shell command and return the result."""
-        print(f"Running: {command}")
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    def set_output_label(self, label):
+        """Prefix command output from the current thread with [label]."""
+        self._output.label = label
+    
+    def log(self, message):
+        """Print a status message, prefixed with the current thread's [label] if set."""
+        label = getattr(self._output, "label", None)
+        print(f"[{label}] {message}" if label else message, flush=True)
+    
+    def run_command(self, argv, check=True):
+        """Run a command (argv list), streaming its output, and return the result."""
+        label = getattr(self._output, "label", None)
+        prefix = f"[{label}] " if label else ""
+        self.log(f"Running: {' '.join(argv)}")
+        
+        if label:
+            # Stream line by line with a prefix so parallel setups stay readable
+            with subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                  text=True, bufsize=1) as proc:
+                for line in proc.stdout:
+                    print(f"{prefix}{line}", end="", flush=True)
+            result = subprocess.CompletedProcess(argv, proc.returncode)
+        else:
+            # Output is inherited rather than captured so long installs show progress
+            result = subprocess.run(argv)
         
-        if result.stdout:
-            print(result.stdout)
-        if result.stderr:
-            print(result.stderr, file=sys.stderr)
-            
         if check and result.returncode != 0:
-            raise subprocess.CalledProcessError(result.returncode, command)
+            raise subprocess.CalledProcessError(result.returncode, argv)
             
         return result
     
     def check_conda_installed(self):
         """Check if conda is installed and accessible."""
         try:
-            self.run_command("conda --version")
+            self.run_command(["conda", "--version"])
             return True
         except (subprocess.CalledProcessError, FileNotFoundError):
             return False
     
     def find_conda_path(self):
         """Find conda installation path."""
-        possible_paths = [
-            "~/miniconda3/etc/profile.d/conda.sh",
-            "~/anaconda3/etc/profile.d/conda.sh",
-            "/opt/conda/etc/profile.d/conda.sh",
-            "/usr/local/conda/etc/profile.d/conda.sh"
+        return find_conda_sh()
+    
+    def conda_platform(self):
+        """Return the conda platform string (e.g. linux-64) for this machine, or None."""
+        system = platform.system().lower()
+        machine = platform.machine().lower()
+        
+        if system == "darwin":
+            system = "osx"
+        if machine in ("x86_64", "amd64"):
+            return f"{system}-64"
+        if machine in ("aarch64", "arm64"):
+            return f"{system}-{'arm64' if system == 'osx' else 'aarch64'}"
+        if machine in ("ppc64le", "s390x"):
+            return f"{system}-{machine}"
+        return None
+    
+    def lock_file_path(self, env_name, conda_platform=None):
+        """Return the path of the lock file for an environment, or None if the platform is unknown."""
+        if conda_platform is None:
+            conda_platform = self.conda_platform()
+        if conda_platform is None:
+            return None
+        return Path(__file__).parent.parent / "locks" / f"{env_name}-{conda_platform}.lock"
+    
+    def generate_lock_file(self, env_name):
+        """Generate an explicit conda-lock file for an environment."""
+        if env_name not in self.config["environments"]:
+            raise ValueError(f"Environment '{env_name}' not found in configuration")
+        
+        env_config = self.config["environments"][env_name]
+        conda_platform = self.conda_platform()
+        if conda_platform is None:
+            raise RuntimeError(f"Unsupported system: {platform.system()} {platform.machine()}")
+        lock_path = self.lock_file_path(env_name, conda_platform)
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # conda-lock resolves from an environment.yml; pip packages are installed separately
+        env_file = lock_path.parent / f"{env_name}-environment.yml"
+        lines = [f"name: {env_name}", "channels:"]
+        lines += [f"  - {channel}" for channel in env_config["channels"]]
+        lines += ["dependencies:", f"  - python={env_config['python']}"]
+        lines += [f"  - {package}" for package in sorted(env_config["packages"]["conda"])]
+        with open(env_file, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        
+        lock_cmd = [
+            sys.executable, "-m", "conda_lock", "lock",
+            "-f", str(env_file),
+            "-p", conda_platform,
+            "--kind", "explicit",
+            "--filename-template", str(lock_path.parent / f"{env_name}-{{platform}}.lock"),
         ]
+        self.run_command(lock_cmd)
+        self.log(f"Lock file created: {lock_path}")
+        return lock_path
+    
+    def environment_hash(self, env_name, include_pip=True):
+        """Return a stable short hash of an environment's configuration.
         
-        for path in possible_paths:
-            expanded_path = os.path.expanduser(path)
-            if os.path.exists(expanded_path):
-                return expanded_path
+        The conda platform is part of the hash so machines of different
+        architectures sharing a home directory never restore each other's
+        environments. When a lock file exists its contents are included too,
+        so regenerating the lock invalidates cached environments.
+        """
+        env_config = self.config["environments"][env_name]
+        if not include_pip:
+            env_config = dict(env_config, packages=dict(env_config["packages"], pip=[]))
+        h = hashlib.sha256(json.dumps(env_config, sort_keys=True).encode())
+        conda_platform = self.conda_platform() or f"{platform.system()}-{platform.machine()}".lower()
+        h.update(conda_platform.encode())
+        lock_path = self.lock_file_path(env_name)
+        if lock_path is not None and lock_path.exists():
+            h.update(lock_path.read_bytes())
+        return h.hexdigest()[:12]
+    
+    def env_cache_path(self, env_name, include_pip=True):
+        """Return the path of the packed environment tarball for the current config."""
+        env_hash = self.environment_hash(env_name, include_pip)
+        return CACHE_DIR / "envs" / f"{env_name}-{env_hash}.tar.zst"
+    
+    def conda_info(self):
+        """Return the output of `conda info --json`."""
+        result = subprocess.run(["conda", "info", "--json"], capture_output=True, text=True, check=True)
+        return json.loads(result.stdout)
+    
+    def find_env_prefix(self, env_name):
+        """Return the prefix of an existing named environment, or None."""
+        info = self.conda_info()
+        envs_dirs = {str(Path(d)) for d in info["envs_dirs"]}
+        for env_path in info["envs"]:
+            env_path = Path(env_path)
+            if env_path.name == env_name and str(env_path.parent) in envs_dirs:
+                return env_path
         return None
     
-    def setup_environment(self, env_name):
-        """Set up a specific conda environment."""
+    def new_env_prefix(self, env_name):
+        """Return where conda would create a new named environment, or None."""
+        for envs_dir in self.conda_info()["envs_dirs"]:
+            # conda uses the first envs dir it can write to (creating it if needed)
+            existing = Path(envs_dir)
+            while not existing.exists():
+                existing = existing.parent
+            if os.access(existing, os.W_OK):
+                return Path(envs_dir) / env_name
+        return None
+    
+    def share_package_cache(self):
+        """Put the shared duke-slurm package cache ahead of conda's own pkgs dirs."""
+        shared = str(CACHE_DIR / "pkgs")
+        pkgs_dirs = os.environ.get("CONDA_PKGS_DIRS")
+        if pkgs_dirs is None:
+            pkgs_dirs = ",".join(self.conda_info()["pkgs_dirs"])
+        if shared not in pkgs_dirs.split(","):
+            os.environ["CONDA_PKGS_DIRS"] = ",".join(filter(None, [shared, pkgs_dirs]))
+    
+    def restore_cached_environment(self, tarball, prefix):
+        """Unpack a cached environment tarball into prefix; return True on success."""
+        if prefix.exists():
+            # Not a conda env we know about; never unpack over (or remove) it
+            self.log(f"Warning: {prefix} already exists, not restoring cached environment")
+            return False
+        
+        self.log(f"Restoring environment from cache: {tarball}")
+        created = False
+        try:
+            prefix.mkdir(parents=True)
+            created = True
+            self.run_command(["tar", "-I", "zstd", "-xf", str(tarball), "-C", str(prefix)])
+            self.run_command([str(prefix / "bin" / "conda-unpack")])
+            return True
+        except (subprocess.CalledProcessError, OSError) as e:
+            if created:
+                shutil.rmtree(prefix, ignore_errors=True)
+            self.log(f"Warning: could not restore cached environment ({e}), creating it instead")
+            return False
+    
+    def prune_environment_cache(self, env_name, keep):
+        """Remove cached tarballs of env_name other than keep."""
+        pattern = f"{glob.escape(env_name)}-{'[0-9a-f]' * 12}.tar.zst"
+        for tarball in keep.parent.glob(pattern):
+            if tarball != keep:
+                tarball.unlink(missing_ok=True)
+                self.log(f"Removed stale environment cache: {tarball}")
+    
+    def cache_environment(self, env_name, tarball):
+        """Pack an environment into a zstd tarball for later restores."""
+        if not (shutil.which("conda-pack") and shutil.which("zstd")):
+            self.log("conda-pack or zstd not found, skipping environment cache")
+            return
+        
+        tarball.parent.mkdir(parents=True, exist_ok=True)
+        tar_path = tarball.with_suffix("")
+        try:
+            self.run_command(["conda", "pack", "-n", env_name, "--format", "tar", "-o", str(tar_path), "--force"])
+            self.run_command(["zstd", "-q", "-f", "--rm", str(tar_path), "-o", str(tarball)])
+            self.log(f"Environment cached: {tarball}")
+            self.prune_environment_cache(env_name, tarball)
+        except subprocess.CalledProcessError as e:
+            tar_path.unlink(missing_ok=True)
+            self.log(f"Warning: could not cache environment: {e}")
+    
+    def setup_environment(self, env_name, include_pip=True):
+        """Set up a specific conda environment.
+        
+        With include_pip=False only the conda packages are installed, so the
+        environment can serve as a shared base for venv overlays.
+        """
         if env_name not in self.config["environments"]:
             raise ValueError(f"Environment '{env_name}' not found in configuration")
             
         env_config = self.config["environments"][env_name]
         
-        print(f"Setting up environment: {env_name}")
-        print(f"Python version: {env_config['python']}")
+        self.log(f"Setting up environment: {env_name}")
+        self.log(f"Python version: {env_config['python']}")
+        self.log(f"Environment hash: {self.environment_hash(env_name, include_pip)}")
         
-        # Create environment
-        create_cmd = f"conda create -n {env_name} python={env_config['python']} -y"
-        self.run_command(create_cmd)
+        # Restore a previously packed environment for this exact configuration
+        tarball = self.env_cache_path(env_name, include_pip)
+        if tarball.exists() and shutil.which("zstd") and self.find_env_prefix(env_name) is None:
+            prefix = self.new_env_prefix(env_name)
+            if prefix is not None and self.restore_cached_environment(tarball, prefix):
+                self.log(f"Environment '{env_name}' setup complete!")
+                return
         
-        # Activate environment and install packages
-        conda_path = self.find_conda_path()
-        if not conda_path:
-            raise RuntimeError("Conda not found. Please install conda first.")
+        # Share downloaded packages across environments and runs
+        self.share_package_cache()
         
-        # Install conda packages
-        if env_config["packages"]["conda"]:
-            conda_packages = " ".join(env_config["packages"]["conda"])
-            channels = " ".join([f"-c {channel}" for channel in env_config["channels"]])
-            conda_install_cmd = f"conda install -n {env_name} {conda_packages} {channels} -y"
-            self.run_command(conda_install_cmd)
+        lock_path = self.lock_file_path(env_name)
+        if lock_path is not None and lock_path.exists():
+            # Explicit lock file: no solve, just download and link
+            self.log(f"Using lock file: {lock_path}")
+            create_cmd = ["conda", "create", "-n", env_name, "--file", str(lock_path), "-y"]
+        else:
+            # Create environment with python and all conda packages in a single solve
+            channels = [flag for channel in env_config["channels"] for flag in ("-c", channel)]
+            create_cmd = (
+                ["conda", "create", "-n", env_name, f"python={env_config['python']}"]
+                + sorted(env_config["packages"]["conda"])
+                + channels
+                + ["-y", "--override-channels"]
+            )
+        self.run_command(create_cmd)
         
         # Install pip packages
-        if env_config["packages"]["pip"]:
-            pip_packages = " ".join(env_config["packages"]["pip"])
-            pip_install_cmd = f"conda run -n {env_name} pip install {pip_packages}"
+        if include_pip and env_config["packages"]["pip"]:
+            pip_install_cmd = ["conda", "run", "-n", env_name, "pip", "install"] + sorted(env_config["packages"]["pip"])
             self.run_command(pip_install_cmd)
         
-        print(f"Environment '{env_name}' setup complete!")
+        self.cache_environment(env_name, tarball)
+        self.log(f"Environment '{env_name}' setup complete!")
+    
+    def create_overlay(self, env_name, overlay_path, requirements_file=None):
+        """Create a venv overlay on top of a shared conda base environment.
+        
+        The overlay sees the base's conda packages through
+        --system-site-packages and only holds the pip packages, so it is
+        small enough to copy or cache per project.
+        """
+        if env_name not in self.config["environments"]:
+            raise ValueError(f"Environment '{env_name}' not found in configuration")
+        
+        prefix = self.find_env_prefix(env_name)
+        if prefix is None:
+            self.setup_environment(env_name, include_pip=False)
+            prefix = self.find_env_prefix(env_name)
+            if prefix is None:
+                raise RuntimeError(f"Base environment '{env_name}' not found after setup")
+        
+        overlay_path = Path(overlay_path).resolve()
+        self.log(f"Creating overlay: {overlay_path} (base: {env_name})")
+        self.run_command([str(prefix / "bin" / "python"), "-m", "venv", "--system-site-packages", str(overlay_path)])
+        
+        pip_cmd = [str(overlay_path / "bin" / "pip"), "install"]
+        if requirements_file:
+            self.run_command(pip_cmd + ["-r", str(requirements_file)])
+        elif self.config["environments"][env_name]["packages"]["pip"]:
+            self.run_command(pip_cmd + sorted(self.config["environments"][env_name]["packages"]["pip"]))
+        
+        self.log(f"Overlay ready. Activate with: source {overlay_path / 'bin' / 'activate'}")
+        return overlay_path
     
     def list_environments(self):
         """List available environments in configuration."""
@@ -186,19 +423,27 @@ echo "PyTorch version: $(python -c 'import torch; print(torch.__version__)' 2>/d
         
         # Make executable
         os.chmod(script_path, 0o755)
-        print(f"Activation script created: {script_path}")
+        self.log(f"Activation script created: {script_path}")
 
 
 def main():
     parser = argparse.ArgumentParser(description="Setup conda environments for deep learning")
-    parser.add_argument("action", choices=["setup", "list", "create-script"], 
+    parser.add_argument("action", choices=["setup", "list", "create-script", "lock", "overlay"], 
                        help="Action to perform")
-    parser.add_argument("--env", "-e", default="torchpy310",
-                       help="Environment name (default: torchpy310)")
+    parser.add_argument("--env", "-e", nargs="+", default=["torchpy310"],
+                       help="Environment name(s), space or comma separated (default: torchpy310)")
     parser.add_argument("--config", "-c", default="config/environments.json",
                        help="Configuration file path")
+    parser.add_argument("--overlay-path", default=".venv",
+                       help="Overlay venv directory for the overlay action (default: .venv)")
+    parser.add_argument("--requirements", "-r",
+                       help="Requirements file for the overlay (default: the environment's pip packages)")
     
     args = parser.parse_args()
+    # Deduplicate (keeping order) so one env is never set up twice concurrently
+    env_names = list(dict.fromkeys(name for value in args.env for name in value.split(",") if name))
+    if not env_names:
+        parser.error("--env requires at least one environment name")
     
     setup = CondaSetup(args.config)
     
@@ -210,14 +455,44 @@ def main():
     if args.action == "list":
         setup.list_environments()
     elif args.action == "setup":
+        def setup_one(env_name):
+            if len(env_names) > 1:
+                setup.set_output_label(env_name)
+            setup.setup_environment(env_name)
+            setup.create_activation_script(env_name)
+        
+        # Export the shared package cache before spawning so parallel setups reuse downloads;
+        # output is tagged per environment since the runs interleave
+        setup.share_package_cache()
+        failed = []
+        with ThreadPoolExecutor(max_workers=min(4, len(env_names))) as executor:
+            futures = {env_name: executor.submit(setup_one, env_name) for env_name in env_names}
+            for env_name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error setting up environment '{env_name}': {e}")
+                    failed.append(env_name)
+        if failed:
+            sys.exit(1)
+    elif args.action == "create-script":
+        for env_name in env_names:
+            setup.create_activation_script(env_name)
+    elif args.action == "lock":
         try:
-            setup.setup_environment(args.env)
-            setup.create_activation_script(args.env)
+            for env_name in env_names:
+                setup.generate_lock_file(env_name)
         except Exception as e:
-            print(f"Error setting up environment: {e}")
+            print(f"Error generating lock file: {e}")
+            sys.exit(1)
+    elif args.action == "overlay":
+        if len(env_names) != 1:
+            parser.error("overlay takes a single --env")
+        try:
+            setup.create_overlay(env_names[0], args.overlay_path, args.requirements)
+        except Exception as e:
+            print(f"Error creating overlay: {e}")
             sys.exit(1)
-    elif args.action == "create-script":
-        setup.create_activation_script(args.env)
 
 
 if __name__ == "__main__":